@@ -2,10 +2,14 @@
 """
 Base tasks for celery.
 """
-from celery import current_app
+from typing import Union
+
+from celery import current_app, states
+from celery.signals import task_failure, task_postrun, task_prerun
 from celery.utils.log import get_task_logger
+from django.core.cache import cache
 
-from celery_tools.concurrency import CacheLock
+from celery_tools.concurrency import CacheLock, DBLock, LockWatchdog, make_lock
 
 LOGGER_DEFAULT_NAME = __name__
 
@@ -13,6 +17,20 @@ LOGGER_DEFAULT_NAME = __name__
 class LoggedTask(current_app.Task):
     TAG = ''
     abstract = True
+    # Log messages including TAG, built once per class
+    _start_msg = ' > Task started'
+    _success_msg = ' > Task (%s) completed with result: %s'
+    _failure_msg = ' > Task (%s) failed'
+    _lock_id = 'lock_'
+
+    def __init_subclass__(cls, **kwargs):
+        super(LoggedTask, cls).__init_subclass__(**kwargs)
+        # Messages logged with args are %-formatted by logging, so TAG has to be escaped only in those
+        tag = cls.TAG.replace('%', '%%')
+        cls._start_msg = '{} > Task started'.format(cls.TAG)
+        cls._success_msg = '{} > Task (%s) completed with result: %s'.format(tag)
+        cls._failure_msg = '{} > Task (%s) failed'.format(tag)
+        cls._lock_id = 'lock_{}'.format(cls.TAG.lower())
 
     def __init__(self, logger=None):
         super(LoggedTask, self).__init__()
@@ -21,46 +39,142 @@ class LoggedTask(current_app.Task):
 
         self.logger = logger
 
-    def __call__(self, *args, **kwargs):
-        self.logger.info("%s > Task started", self.TAG)
-        return super(LoggedTask, self).__call__(*args, **kwargs)
-
     def run(self, *args, **kwargs):
         super(LoggedTask, self).run(*args, **kwargs)
 
-    def on_success(self, retval, task_id, args, kwargs):
-        self.logger.info("%s > Task (%s) completed with result: %s", self.TAG, str(task_id), str(retval))
-        super(LoggedTask, self).on_success(retval, task_id, args, kwargs)
-
-    def on_failure(self, exc, task_id, args, kwargs, einfo):
-        self.logger.error("%s > Task (%s) failed", self.TAG, str(task_id), exc_info=exc)
-        super(LoggedTask, self).on_failure(exc, task_id, args, kwargs, einfo)
+    def _executed(self) -> bool:
+        """
+        Check if current execution has actually run the task.
+        """
+        return True
 
 
 class LoggedSingleTask(LoggedTask):
     abstract = True
     single_run = True
-
-    def __init__(self, *args, **kwargs):
-        super(LoggedSingleTask, self).__init__(*args, **kwargs)
-        lock_id = 'lock_{}'.format(self.TAG.lower())
-        self.lock = CacheLock(cache_key=lock_id)
+    # Seconds to expire the lock if it isn't renewed, so it is freed when worker dies. It should be several times the
+    # expected task runtime. Lock is renewed every third of this time while task is running.
+    lock_timeout = 300
+    # Lock backend, 'cache' or 'db' (PostgreSQL advisory locks, that don't expire and don't need renewal)
+    lock_backend = 'cache'
+    # Seconds to keep the mark of a revoked task, so it is skipped when a worker receives it
+    revoke_timeout = 24 * 60 * 60
+    _lock = None
+
+    @property
+    def lock(self) -> Union[CacheLock, DBLock]:
+        """
+        Lock shared by all instances of this task class, created on first use.
+        """
+        cls = type(self)
+        if cls.__dict__.get('_lock') is None:
+            cls._lock = make_lock(cache_key=cls._lock_id, timeout=cls.lock_timeout, backend=cls.lock_backend)
+
+        return cls._lock
+
+    @classmethod
+    def revoke_key(cls, task_id: str) -> str:
+        return 'revoked_{}'.format(task_id)
+
+    def mark_revoked(self, task_id: str):
+        """
+        Mark a task execution as revoked, so it will be skipped by the worker that receives it. Unlike Celery revoke,
+        this doesn't broadcast a message to every worker, but every execution of a single task checks the mark with a
+        cache request.
+
+        :param task_id: Task id.
+        """
+        cache.set(self.revoke_key(task_id), True, self.revoke_timeout)
 
     def __call__(self, *args, **kwargs):
-        if self.lock.acquire():
-            result = super(LoggedSingleTask, self).__call__(*args, **kwargs)
-            self.lock.release()
-            return result
+        # Direct calls don't run on_success nor on_failure, so lock is released here and it isn't renewed
+        if self.request.called_directly:
+            token = self.lock.acquire()
+            if token is None:
+                return False
+
+            try:
+                self.logger.info(self._start_msg)
+                return super(LoggedSingleTask, self).__call__(*args, **kwargs)
+            finally:
+                self.lock.release(token)
+
+        revoke_key = self.revoke_key(self.request.id)
+        if cache.get(revoke_key, False):
+            cache.delete(revoke_key)
+            return False
+
+        # Lock token and watchdog belong to this execution, so they are kept in its request instead of the task instance
+        # that is shared by concurrent executions in the same process. Task id is used as lock token, so retries of this
+        # task can acquire the lock again
+        self.request.lock_token = self.lock.acquire(token=self.request.id)
+        if self.request.lock_token is not None:
+            if self.lock_timeout is not None and self.lock_backend == 'cache':
+                self.request.lock_watchdog = LockWatchdog(self.lock, self.request.lock_token, self.lock_timeout / 3)
+                self.request.lock_watchdog.start()
+
+            # Start is logged here instead of task_prerun, so executions skipped due to the lock are not logged
+            self.logger.info(self._start_msg)
+
+            # Run directly, as Celery Task.__call__ pushes a new request without task id, so retries wouldn't be sent
+            return self.run(*args, **kwargs)
         else:
             return False
 
+    def _executed(self) -> bool:
+        return getattr(self.request, 'lock_token', None) is not None
+
+    def _stop_watchdog(self):
+        watchdog = getattr(self.request, 'lock_watchdog', None)
+        if watchdog is not None:
+            watchdog.stop()
+            self.request.lock_watchdog = None
+
+    def _release_lock(self):
+        self._stop_watchdog()
+        self.lock.release(getattr(self.request, 'lock_token', None))
+
     def on_success(self, retval, task_id, args, kwargs):
-        self.lock.release()
+        self._release_lock()
         super(LoggedSingleTask, self).on_success(retval, task_id, args, kwargs)
 
+    def on_retry(self, exc, task_id, args, kwargs, einfo):
+        # Keep the lock for the retry, that acquires it again using the same task id. Database locks belong to the
+        # session of this worker, so they cannot be handed over and are released.
+        if self.lock_backend == 'db':
+            self._release_lock()
+        else:
+            self._stop_watchdog()
+
+        super(LoggedSingleTask, self).on_retry(exc, task_id, args, kwargs, einfo)
+
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        self.lock.release()
+        self._release_lock()
         super(LoggedSingleTask, self).on_failure(exc, task_id, args, kwargs, einfo)
 
 
+@task_prerun.connect
+def log_task_started(sender=None, **kwargs):
+    """
+    Log start of LoggedTask executions. LoggedSingleTask logs it once the lock is acquired.
+    """
+    if isinstance(sender, LoggedTask) and not isinstance(sender, LoggedSingleTask):
+        sender.logger.info(sender._start_msg)
+
+
+@task_postrun.connect
+def log_task_completed(sender=None, task_id=None, retval=None, state=None, **kwargs):
+    """
+    Log result of LoggedTask executions completed successfully, skipping the ones that didn't run the task.
+    """
+    if isinstance(sender, LoggedTask) and state == states.SUCCESS and sender._executed():
+        sender.logger.info(sender._success_msg, task_id, retval)
+
 
+@task_failure.connect
+def log_task_failed(sender=None, task_id=None, exception=None, **kwargs):
+    """
+    Log LoggedTask executions failed.
+    """
+    if isinstance(sender, LoggedTask):
+        sender.logger.error(sender._failure_msg, task_id, exc_info=exception)
@@ -2,15 +2,36 @@
 """
 Concurrency utils.
 """
-from django.core.cache import cache
+import hashlib
+import threading
+import uuid
+from typing import Dict, Iterable, Optional, Union
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+try:
+    from django_redis import get_redis_connection
+    from django_redis.cache import RedisCache
+except ImportError:  # pragma: no cover
+    get_redis_connection = None
+    RedisCache = None
+
+
+def _uses_redis_cache() -> bool:
+    return RedisCache is not None and isinstance(caches[DEFAULT_CACHE_ALIAS], RedisCache)
 
 
 class CacheLock(object):
     """
     A Lock implementation.
 
-    A lock manages an internal value that is 0 or nonexistent when lock is free and 1 when is closed. Can be locked
-    calling acquire() and freed calling release().
+    A lock manages an internal value that is nonexistent when lock is free and a unique token when is closed. Can be
+    locked calling acquire(), that returns the token, and freed calling release() with that token. Lock is reentrant
+    for its token, so acquiring it again with the token that holds it succeeds.
+
+    Lock relies on atomic cache add operation, so cache backend must provide it (e.g. memcached or Redis). Local memory
+    cache is not shared between processes, so it is not suitable for multi-process setups.
     """
     def __init__(self, cache_key: str, timeout: int=None):
         """
@@ -22,27 +43,293 @@ class CacheLock(object):
         self._cache_key = cache_key
         self._timeout = timeout
 
-    def acquire(self):
+    def acquire(self, token: str=None) -> Optional[str]:
         """
         Acquire the lock, blocking follow calls.
 
-        :return: True if lock have been acquired, otherwise False.
+        :param token: Token that identifies the lock owner. A random one is used if not given.
+        :return: Lock token if lock have been acquired, otherwise None.
         """
-        if not self.locked():
-            cache.add(self._cache_key, 1, self._timeout)
-            result = True
-        else:
-            result = False
-        return result
+        if token is None:
+            token = uuid.uuid4().hex
 
-    def release(self):
-        cache.delete(self._cache_key)
+        if cache.add(self._cache_key, token, self._timeout) or cache.get(self._cache_key) == token:
+            return token
 
-    def locked(self):
-        return cache.get(self._cache_key, 0) == 1
+        return None
 
-    def __del__(self):
-        return self.release()
+    def release(self, token: str):
+        """
+        Release the lock only if it is held with given token, so a lock acquired by someone else is never freed.
+
+        :param token: Token returned by acquire().
+        """
+        if token is not None and cache.get(self._cache_key) == token:
+            cache.delete(self._cache_key)
+
+    def renew(self, token: str) -> bool:
+        """
+        Extend lock expiration time by its timeout, only if it is held with given token.
+
+        :param token: Token returned by acquire().
+        :return: True if lock have been renewed, otherwise False.
+        """
+        return token is not None and cache.get(self._cache_key) == token and cache.touch(self._cache_key, self._timeout)
+
+    def locked(self) -> bool:
+        """
+        Check if lock is closed.
+
+        :return: True if lock is closed, otherwise False.
+        """
+        return cache.get(self._cache_key) is not None
+
+
+class RedisLock(CacheLock):
+    """
+    A Lock implementation using Redis directly. Inherit from CacheLock.
+
+    Lock is acquired with a single atomic SET NX command, run from a Lua script to be reentrant, and released with a Lua
+    script that deletes the key only if it still holds the lock token. Requires django-redis as Django cache backend.
+    """
+    ACQUIRE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return 1
+        elseif tonumber(ARGV[2]) > 0 then
+            return redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+        else
+            return redis.call('set', KEYS[1], ARGV[1], 'NX') and 1 or 0
+        end
+    """
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        else
+            return 0
+        end
+    """
+    RENEW_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        else
+            return 0
+        end
+    """
+
+    def __init__(self, cache_key: str, timeout: int=None):
+        """
+        Create a Lock using Redis connection of Django cache as backend.
+
+        :param cache_key: Key that will be used in cache to store the lock.
+        :param timeout: Time to expire.
+        """
+        super(RedisLock, self).__init__(cache_key, timeout)
+        self._redis_key = cache.make_key(cache_key)
+        self._redis = get_redis_connection()
+        self._acquire_script = self._redis.register_script(self.ACQUIRE_SCRIPT)
+        self._release_script = self._redis.register_script(self.RELEASE_SCRIPT)
+        self._renew_script = self._redis.register_script(self.RENEW_SCRIPT)
+
+    def acquire(self, token: str=None) -> Optional[str]:
+        """
+        Acquire the lock, blocking follow calls.
+
+        :param token: Token that identifies the lock owner. A random one is used if not given.
+        :return: Lock token if lock have been acquired, otherwise None.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+
+        px = int(self._timeout * 1000) if self._timeout is not None else 0
+        return token if self._acquire_script(keys=[self._redis_key], args=[token, px]) else None
+
+    def release(self, token: str):
+        """
+        Release the lock only if it is held with given token, so a lock acquired by someone else is never freed.
+
+        :param token: Token returned by acquire().
+        """
+        if token is not None:
+            self._release_script(keys=[self._redis_key], args=[token])
+
+    def renew(self, token: str) -> bool:
+        """
+        Extend lock expiration time by its timeout, only if it is held with given token.
+
+        :param token: Token returned by acquire().
+        :return: True if lock have been renewed, otherwise False.
+        """
+        if token is None or self._timeout is None:
+            return False
+
+        return bool(self._renew_script(keys=[self._redis_key], args=[token, int(self._timeout * 1000)]))
+
+    def locked(self) -> bool:
+        """
+        Check if lock is closed.
+
+        :return: True if lock is closed, otherwise False.
+        """
+        return bool(self._redis.exists(self._redis_key))
+
+
+class DBLock(object):
+    """
+    A Lock implementation using PostgreSQL advisory locks.
+
+    Lock is held by the database session of current thread, so it doesn't need a timeout: it is freed by PostgreSQL when
+    the session ends, e.g. when worker dies. Advisory locks are reentrant for a session, so the lock also tracks the
+    token it has been acquired with to refuse being acquired twice by the same process with a different token.
+    """
+    def __init__(self, key: str, using: str=DEFAULT_DB_ALIAS):
+        """
+        Create a Lock using Django database as backend.
+
+        :param key: Key that identifies the lock, hashed to a PostgreSQL advisory lock id.
+        :param using: Database alias.
+        """
+        self._key = key
+        self._lock_id = int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big', signed=True)
+        self._using = using
+        self._token = None
+
+    def _execute(self, query: str, params: list=None) -> bool:
+        with connections[self._using].cursor() as cursor:
+            cursor.execute(query, [self._lock_id] if params is None else params)
+            return cursor.fetchone()[0]
+
+    def acquire(self, token: str=None) -> Optional[str]:
+        """
+        Acquire the lock, blocking follow calls.
+
+        :param token: Token that identifies the lock owner. A random one is used if not given.
+        :return: Lock token if lock have been acquired, otherwise None.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+
+        if self._token is not None:
+            return token if token == self._token else None
+
+        if not self._execute('SELECT pg_try_advisory_lock(%s)'):
+            return None
+
+        self._token = token
+        return self._token
+
+    def release(self, token: str):
+        """
+        Release the lock only if it is held with given token, so a lock acquired by someone else is never freed.
+
+        :param token: Token returned by acquire().
+        """
+        if token is not None and token == self._token:
+            self._execute('SELECT pg_advisory_unlock(%s)')
+            self._token = None
+
+    def renew(self, token: str) -> bool:
+        """
+        Lock doesn't expire, so it only checks that lock is held with given token.
+
+        :param token: Token returned by acquire().
+        :return: True if lock is held with given token, otherwise False.
+        """
+        return token is not None and token == self._token
+
+    def locked(self) -> bool:
+        """
+        Check if lock is closed.
+
+        :return: True if lock is closed, otherwise False.
+        """
+        if self._token is not None:
+            return True
+
+        # Bigint advisory locks are listed in pg_locks split in high (classid) and low (objid) 32 bits
+        lock_id = self._lock_id & 0xFFFFFFFFFFFFFFFF
+        return self._execute(
+            'SELECT EXISTS (SELECT 1 FROM pg_locks WHERE locktype = %s AND granted '
+            'AND database = (SELECT oid FROM pg_database WHERE datname = current_database()) '
+            'AND classid = %s::bigint::oid AND objid = %s::bigint::oid AND objsubid = 1)',
+            ['advisory', lock_id >> 32, lock_id & 0xFFFFFFFF],
+        )
+
+
+class LockWatchdog(threading.Thread):
+    """
+    A daemon thread that keeps renewing a lock while its owner is running.
+
+    Lock can be created with a timeout, so it is freed if owner dies, and still be held by long running owners.
+    """
+    def __init__(self, lock: CacheLock, token: str, interval: float):
+        """
+        Create a watchdog for given lock.
+
+        :param lock: Lock to renew.
+        :param token: Token returned by lock acquire().
+        :param interval: Seconds between renewals, should be lower than lock timeout.
+        """
+        super(LockWatchdog, self).__init__(daemon=True)
+        self._lock = lock
+        self._token = token
+        self._interval = interval
+        self._finished = threading.Event()
+
+    def run(self):
+        # Stop renewing when asked or when lock is no longer held with this token
+        while not self._finished.wait(self._interval):
+            if not self._lock.renew(self._token):
+                break
+
+    def stop(self):
+        """
+        Stop renewing the lock.
+        """
+        self._finished.set()
+
+
+def make_lock(cache_key: str, timeout: int=None, backend: str='cache') -> Union[CacheLock, DBLock]:
+    """
+    Create a Lock using given backend.
+
+    :param cache_key: Key that will be used to store the lock.
+    :param timeout: Time to expire. Ignored by database backend, whose locks are freed when session ends.
+    :param backend: 'cache' to use the best implementation for current Django cache backend, RedisLock if it is
+    django-redis, otherwise CacheLock. 'db' to use DBLock.
+    :return: Lock.
+    """
+    if backend == 'db':
+        return DBLock(cache_key)
+
+    if backend != 'cache':
+        raise ValueError("Lock backend must be 'cache' or 'db'")
+
+    if _uses_redis_cache():
+        return RedisLock(cache_key, timeout)
+
+    return CacheLock(cache_key, timeout)
+
+
+def locked_keys(cache_keys: Iterable[str]) -> Dict[str, str]:
+    """
+    Check which locks are closed using a single cache request.
+
+    :param cache_keys: Keys of locks created with make_lock().
+    :return: Token holding each closed lock, by lock key.
+    """
+    cache_keys = list(cache_keys)
+    if not cache_keys:
+        return {}
+
+    if _uses_redis_cache():
+        values = get_redis_connection().mget([cache.make_key(key) for key in cache_keys])
+        return {
+            key: value.decode() if isinstance(value, bytes) else value
+            for key, value in zip(cache_keys, values)
+            if value is not None
+        }
+
+    return cache.get_many(cache_keys)
 
 
 class CacheSemaphore(object):
@@ -51,7 +338,16 @@ class CacheSemaphore(object):
 
     A semaphore manages an internal counter which is decremented by each acquire() call and incremented by each
     release() call. The counter can never go below zero; when acquire() finds that it is zero, it raise ValueError.
+
+    Cache stores the number of acquired values instead of the counter, so acquire() increments it with an atomic cache
+    incr and gives the values back if they exceed the semaphore capacity. This works on every backend providing atomic
+    incr and decr, including memcached. Acquired values start over a reserve, so releases over the initial value don't
+    reach zero, that memcached doesn't decrement below. They are stored under '<cache_key>_acquired', so keys of the
+    previous counter format are never misread.
     """
+    # Acquired values kept in cache over the ones actually acquired, to allow releases over the initial value
+    RELEASE_RESERVE = 2 ** 32
+
     def __init__(self, cache_key: str, value: int=1):
         """
         Create a semaphore with Django cache as backend.
@@ -59,11 +355,31 @@ class CacheSemaphore(object):
         :param cache_key: Key that will be used in cache to store the semaphore.
         :param value: Initial value.
         """
-        self._cache_key = cache_key
+        self._cache_key = '{}_acquired'.format(cache_key)
+        self._capacity = self._get_capacity(value)
+        self._initial_acquired = self._capacity - value
 
         # Add cache key with given value if key isn't present
-        if not cache.get(self._cache_key, False):
-            cache.set(self._cache_key, value, None)
+        cache.add(self._cache_key, self._initial_acquired, None)
+
+    def _get_capacity(self, value: int) -> int:
+        return value + self.RELEASE_RESERVE
+
+    def _incr(self, value: int) -> int:
+        try:
+            return cache.incr(self._cache_key, value)
+        except ValueError:
+            # Key is missing, so initialize it and try again
+            cache.add(self._cache_key, self._initial_acquired, None)
+            return cache.incr(self._cache_key, value)
+
+    def _decr(self, value: int) -> int:
+        try:
+            return cache.decr(self._cache_key, value)
+        except ValueError:
+            # Key is missing, so initialize it and try again
+            cache.add(self._cache_key, self._initial_acquired, None)
+            return cache.decr(self._cache_key, value)
 
     def acquire(self, value: int=1) -> bool:
         """
@@ -73,11 +389,14 @@ class CacheSemaphore(object):
         :param value: Number of values to acquire.
         :return: True if semaphore acquired.
         """
-        current_value = self.value()
+        acquired = self._incr(value)
+
+        # Semaphore value before this call is capacity - (acquired - value)
+        current_value = self._capacity - acquired + value
         if current_value < 1 or current_value < value:
+            cache.decr(self._cache_key, value)
             raise ValueError('Semaphore cannot be acquired')
 
-        cache.decr(self._cache_key, value)
         return True
 
     def acquire_all(self):
@@ -96,7 +415,7 @@ class CacheSemaphore(object):
 
         :return: Current value.
         """
-        return cache.get(self._cache_key, 0)
+        return self._capacity - cache.get(self._cache_key, self._initial_acquired)
 
     def locked(self) -> bool:
         """
@@ -112,7 +431,7 @@ class CacheSemaphore(object):
 
         :param value:  Number of values to release.
         """
-        cache.incr(self._cache_key, value)
+        self._decr(value)
 
     def delete(self):
         """
@@ -128,8 +447,23 @@ class CacheBoundedSemaphore(CacheSemaphore):
     """
     A bounded semaphore implementation. Inherit from CacheSemaphore.
 
-    This cannot have more slots than a max value.
+    This cannot have more slots than a max value, so its capacity is the max value and acquired values can never go
+    below zero. When Django cache backend is django-redis, values are released with a Lua script that clamps and
+    decrements acquired values atomically.
     """
+    RELEASE_SCRIPT = """
+        local acquired = tonumber(redis.call('get', KEYS[1]))
+        if acquired == nil then
+            acquired = tonumber(ARGV[2])
+            redis.call('set', KEYS[1], acquired)
+        end
+        local decrement = math.min(tonumber(ARGV[1]), acquired)
+        if decrement > 0 then
+            return redis.call('decrby', KEYS[1], decrement)
+        end
+        return acquired
+    """
+
     def __init__(self, cache_key: str, value: int=1, max_value: int=None):
         """
         Create a bounded semaphore with Django cache as backend.
@@ -138,7 +472,6 @@ class CacheBoundedSemaphore(CacheSemaphore):
         :param value: Initial value.
         :param max_value: Max value.
         """
-        super(CacheBoundedSemaphore, self).__init__(cache_key, value)
         if max_value is None:
             max_value = value
 
@@ -146,6 +479,15 @@ class CacheBoundedSemaphore(CacheSemaphore):
             raise ValueError("Initial value cannot be greater than max value")
 
         self._max_value = max_value
+        super(CacheBoundedSemaphore, self).__init__(cache_key, value)
+
+        self._release_script = None
+        if _uses_redis_cache():
+            self._redis_key = cache.make_key(self._cache_key)
+            self._release_script = get_redis_connection().register_script(self.RELEASE_SCRIPT)
+
+    def _get_capacity(self, value: int) -> int:
+        return self._max_value
 
     def full(self) -> bool:
         """
@@ -153,7 +495,7 @@ class CacheBoundedSemaphore(CacheSemaphore):
 
         :return: True if semaphore is full, otherwise False.
         """
-        return cache.get(self._cache_key, self._max_value) >= self._max_value
+        return self.value() >= self._max_value
 
     def release(self, value: int=1):
         """
@@ -162,11 +504,14 @@ class CacheBoundedSemaphore(CacheSemaphore):
 
         :param value:  Number of values to release.
         """
-        current_value = self.value()
-        if value > (self._max_value - current_value):
-            value = self._max_value - current_value
-
-        cache.incr(self._cache_key, value)
+        if self._release_script is not None:
+            self._release_script(keys=[self._redis_key], args=[value, self._initial_acquired])
+            return
+
+        acquired = self._decr(value)
+        if acquired < 0:
+            # Take back values released under zero, only the ones released by this call
+            cache.incr(self._cache_key, min(value, -acquired))
 
     def release_all(self):
         """
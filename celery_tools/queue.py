@@ -2,15 +2,34 @@
 """
 Queue utils.
 """
-from celery.bin.amqp import amqp
+from typing import Dict, Iterable
 
 
-def clear_queue(app: 'celery.Celery', name: str):
+def clear_queues(app: 'celery.Celery', names: Iterable[str]) -> Dict[str, int]:
+    """
+    Clear Celery queues using a single connection.
+
+    Only messages ready in the queues are purged, messages delivered to consumers and not acked yet are kept.
+
+    :param app: Celery app.
+    :param names: Queue names.
+    :return: Number of messages purged by queue name.
+    """
+    purged = {}
+    with app.connection_for_write() as connection:
+        channel = connection.default_channel
+        for name in names:
+            purged[name] = channel.queue_purge(name) or 0
+
+    return purged
+
+
+def clear_queue(app: 'celery.Celery', name: str) -> int:
     """
     Clear a Celery queue.
 
     :param app: Celery app.
     :param name: Queue name.
+    :return: Number of messages purged.
     """
-    manager = amqp(app=app)
-    manager.run('queue.purge', name)
+    return clear_queues(app, [name])[name]
@@ -2,18 +2,103 @@
 """
 Celery signals.
 """
+import functools
 import logging
+import time
+from typing import Dict
 
 from celery import current_app
+from celery.signals import celeryd_init, worker_process_init
 
+from celery_tools.concurrency import locked_keys
 
-def prevent_single_task_duplication(sender, body, **kwargs):
-    # Get task class
-    task = current_app.tasks.get(sender)
+logger = logging.getLogger('celery.tasks')
 
-    logger = logging.getLogger('celery.tasks')
+# App task registry, bound once to avoid resolving current_app proxy on every call
+_tasks = None
+# Size of the registry when single run tasks were collected, to collect them again when more tasks are registered
+_tasks_count = 0
 
-    # Check if is a Single task and revoke if is being executed
-    if getattr(task, 'single_run', False) and hasattr(task, 'lock') and task.lock.locked():
-        logger.info("%s > Task (%s) revoked due is currently being executed", task.TAG, body['id'])
-        current_app.control.revoke(body['id'])
+# Names of tasks that cannot run concurrently, loaded once from the app registry
+SINGLE_RUN_TASKS = None
+# Lock key of each single run task using a cache lock
+SINGLE_RUN_LOCK_KEYS = None
+
+# Seconds that single run tasks being executed are remembered, so publish bursts share a single cache request
+LOCKED_TASKS_TTL = 0.05
+
+
+@celeryd_init.connect
+@worker_process_init.connect
+def load_single_run_tasks(**kwargs):
+    """
+    Bind the app task registry and collect names of single run tasks from it.
+    """
+    global _tasks, _tasks_count, SINGLE_RUN_TASKS, SINGLE_RUN_LOCK_KEYS
+    _tasks = current_app.tasks
+    _tasks_count = len(_tasks)
+    # Lock is looked up on the class and the instance, so lock properties are not evaluated
+    SINGLE_RUN_TASKS = frozenset(
+        name
+        for name, task in _tasks.items()
+        if getattr(task, 'single_run', False) and (hasattr(type(task), 'lock') or 'lock' in vars(task))
+    )
+    SINGLE_RUN_LOCK_KEYS = {
+        name: _tasks[name]._lock_id
+        for name in SINGLE_RUN_TASKS
+        if getattr(_tasks[name], 'lock_backend', None) == 'cache' and hasattr(_tasks[name], '_lock_id')
+    }
+    _get_locked_tasks.cache_clear()
+
+
+def get_locked_tasks() -> Dict[str, str]:
+    """
+    Get single run tasks that are being executed, checking all their locks at once.
+
+    :return: Token holding the lock, that is the id of the task being executed, by task name.
+    """
+    return _get_locked_tasks(int(time.monotonic() // LOCKED_TASKS_TTL))
+
+
+@functools.lru_cache(maxsize=1)
+def _get_locked_tasks(time_slot: int) -> Dict[str, str]:
+    # Only called once per time slot, later calls in the same slot are served from lru_cache
+    tokens = locked_keys(SINGLE_RUN_LOCK_KEYS.values())
+    return {name: tokens[key] for name, key in SINGLE_RUN_LOCK_KEYS.items() if key in tokens}
+
+
+def prevent_single_task_duplication(sender, body, headers=None, **kwargs):
+    """
+    Skip Single tasks published while another execution of them is running. Connect it to before_task_publish.
+
+    Revoked executions are marked in cache and skipped by the worker that receives them, instead of broadcasting a
+    revoke to every worker. Celery 5.1+ also provides worker_deduplicate_successful_tasks setting that, with a
+    persistent result backend, skips redelivered tasks that already succeeded; use it when only that is needed.
+    """
+    # Publishers other than workers don't receive celeryd_init, so load single run tasks on first use. Tasks can also
+    # be registered later (e.g. autodiscovered after celeryd_init), so load them again when the registry grows
+    if _tasks is None or len(_tasks) != _tasks_count:
+        load_single_run_tasks()
+
+    # Skip tasks that are not Single tasks
+    if sender not in SINGLE_RUN_TASKS:
+        return
+
+    # Task protocol 2 sends task id in headers, protocol 1 in body
+    task_id = headers['id'] if headers and 'id' in headers else body['id']
+
+    # Check if Single task is being executed and revoke it. Cache locks are checked all at once, and a lock held with
+    # the id of the published task means it is a retry of the running execution, so it isn't revoked
+    if sender in SINGLE_RUN_LOCK_KEYS:
+        token = get_locked_tasks().get(sender)
+        locked = token is not None and token != task_id
+    else:
+        locked = _tasks[sender].lock.locked()
+
+    if locked:
+        task = _tasks[sender]
+        logger.info("%s > Task (%s) revoked due is currently being executed", getattr(task, 'TAG', sender), task_id)
+        if hasattr(task, 'mark_revoked'):
+            task.mark_revoked(task_id)
+        else:
+            current_app.control.revoke(task_id)